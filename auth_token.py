@@ -67,7 +67,7 @@ def read_private_key_file(filepath: str) -> str:
             key = ''.join(key.split())
             if len(key) != 128:  # 64 bytes = 128 hex chars
                 raise ValueError(f"Invalid private key length: {len(key)} (expected 128)")
-            int(key, 16)
+            bytes.fromhex(key)  # Validate it's hex
             return key
     except FileNotFoundError:
         raise Exception(f"Private key file not found: {filepath}")
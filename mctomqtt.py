@@ -7,8 +7,8 @@ import threading
 import argparse
 import re
 import time
-import calendar
 import logging
+from collections import deque
 from datetime import datetime
 from time import sleep
 from auth_token import create_auth_token, read_private_key_file
@@ -20,6 +20,19 @@ except ImportError:
     print("pip install paho-mqtt")
     sys.exit(1)
 
+MQTT_OK = mqtt.MQTT_ERR_SUCCESS
+
+# Use orjson for payload encoding when it is installed (returns UTF-8 bytes, which paho publishes as-is)
+try:
+    import orjson
+    encode_json = orjson.dumps
+except ImportError:
+    # Single reusable encoder with compact separators for smaller payloads
+    encode_json = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+# KEY=VALUE line in a .env file; comment, blank and malformed lines don't match
+ENV_LINE_PATTERN = re.compile(r"\s*([^#=\s][^=]*?)\s*=\s*(.*?)\s*$")
+
 def load_env_files():
     """Load environment variables from .env and .env.local files"""
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -32,17 +45,13 @@ def load_env_files():
         if not os.path.exists(filepath):
             return env_vars
         
+        match_line = ENV_LINE_PATTERN.match
         with open(filepath, 'r') as f:
             for line in f:
-                line = line.strip()
-                # Skip comments and empty lines
-                if not line or line.startswith('#'):
-                    continue
                 # Parse KEY=VALUE
-                if '=' in line:
-                    key, value = line.split('=', 1)
-                    key = key.strip()
-                    value = value.strip()
+                line_match = match_line(line)
+                if line_match:
+                    key, value = line_match.groups()
                     # Remove quotes if present
                     if value and value[0] in ('"', "'") and value[-1] == value[0]:
                         value = value[1:-1]
@@ -68,10 +77,23 @@ load_env_files()
 
 # Regex patterns for message parsing
 RAW_PATTERN = re.compile(r"(\d{2}:\d{2}:\d{2}) - (\d{1,2}/\d{1,2}/\d{4}) U RAW: (.*)")
-PACKET_PATTERN = re.compile(
+PACKET_HEADER_PATTERN = re.compile(
     r"(\d{2}:\d{2}:\d{2}) - (\d{1,2}/\d{1,2}/\d{4}) U: (RX|TX), len=(\d+) \(type=(\d+), route=([A-Z]), payload_len=(\d+)\)"
-    r"(?: SNR=(-?\d+) RSSI=(-?\d+) score=(\d+)( time=(\d+))? hash=([0-9A-F]+)(?: \[(.*)\])?)?"
 )
+# Optional RX-only tail, matched from the end of the header
+PACKET_RX_TAIL_PATTERN = re.compile(
+    r" SNR=(-?\d+) RSSI=(-?\d+) score=(\d+)(?: time=(\d+))? hash=([0-9A-F]+)(?: \[(.*)\])?"
+)
+# Bound match methods skip the pattern attribute lookup on every line
+_match_packet_header = PACKET_HEADER_PATTERN.match
+_match_packet_rx_tail = PACKET_RX_TAIL_PATTERN.match
+# Shared lower-case direction strings, instead of a new str per packet from .lower()
+_DIRECTIONS = {"RX": "rx", "TX": "tx"}
+
+# Characters not allowed in MQTT client IDs
+_sanitize_client_id_chars = re.compile(r"[^a-zA-Z0-9_-]").sub
+# Whitespace the firmware may include inside the printed private key
+_strip_whitespace = re.compile(r"\s+").sub
 
 # Initialize logging (console only)
 logging.basicConfig(
@@ -82,8 +104,6 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 class MeshCoreBridge:
-    last_raw: bytes = None
-
     def __init__(self, debug=False):
         self.debug = debug
         self.repeater_name = None
@@ -94,16 +114,32 @@ class MeshCoreBridge:
         self.model = None
         self.client_version = self._load_client_version()
         self.ser = None
-        self.mqtt_clients = []
+        self.mqtt_clients = {}  # broker_num -> client info
         self.mqtt_connected = False
         self.connection_events = {}  # Track connection completion per broker
         self.should_exit = False
-        self.global_iata = os.getenv('MCTOMQTT_IATA', 'XXX')
+        # Configuration is static after startup, so snapshot the MCTOMQTT_ variables once
+        self.env = {key[9:]: value for key, value in os.environ.items() if key.startswith("MCTOMQTT_")}
+        self.global_iata = self.get_env('IATA', 'XXX')
+        self.topics = {}  # broker_num -> {topic type: resolved topic}, filled when each broker is set up
+        self.active_topic_types = set()  # Topic types at least one broker publishes to
+        self.message_prefix = None  # Pre-encoded origin fields shared by every published message
+        self.last_raw = None  # Most recent RAW line, attached to the packet line that follows it
+        self.last_raw_time = 0.0
+        self.raw_max_age = 2.0  # Seconds before a RAW line is considered stale
+        self.timestamp_cache = (0, "")  # (epoch second, formatted date/time up to the second)
         self.reconnect_delay = 1.0  # Start with 1 second
         self.max_reconnect_delay = 120.0  # Max 2 minutes
         self.reconnect_backoff = 1.5  # Exponential backoff multiplier
-        self.token_cache = {}  # Cache tokens with their creation time
+        self.token_cache = {}  # Token audience -> (token, creation time), shared by brokers with the same audience
         self.token_ttl = 3600  # 1 hour token TTL
+        self.encode_json = encode_json
+        self.publish_queue = deque(maxlen=1024)  # Oldest messages are dropped when full
+        self.publish_event = threading.Event()
+        self.dropped = {}  # queue name -> messages dropped because the queue was full
+        self.drop_warned_at = {}  # queue name -> monotonic time the next drop warning may be logged
+        self.rx_queue = deque(maxlen=1024)  # Serial lines waiting to be parsed
+        self.rx_event = threading.Event()
         
         logger.info("Configuration loaded from environment variables")
     
@@ -119,12 +155,22 @@ class MeshCoreBridge:
                     git_hash = version_data.get('git_hash', 'unknown')
                     return f"meshcoretomqtt/{installer_ver}-{git_hash}"
         except Exception as e:
-            logger.debug(f"Could not load version info: {e}")
+            logger.debug("Could not load version info: %s", e)
         return "meshcoretomqtt/unknown"
     
+    def _iso_now(self):
+        """Current local time in ISO 8601 format, re-formatting the date/time part only once per second"""
+        now = time.time()
+        second = int(now)
+        cached_second, prefix = self.timestamp_cache
+        if second != cached_second:
+            prefix = datetime.fromtimestamp(second).isoformat()
+            self.timestamp_cache = (second, prefix)
+        return f"{prefix}.{int((now - second) * 1000000):06d}"
+
     def get_env(self, key, fallback=''):
         """Get environment variable with fallback (all vars are MCTOMQTT_ prefixed)"""
-        return os.getenv(f"MCTOMQTT_{key}", fallback)
+        return self.env.get(key, fallback)
     
     def get_env_bool(self, key, fallback=False):
         """Get boolean environment variable, checking MCTOMQTT_ prefix first"""
@@ -169,17 +215,21 @@ class MeshCoreBridge:
         global_topic = self.get_env(f'TOPIC_{topic_type_upper}', '')
         return self.resolve_topic_template(global_topic, broker_num)
 
-    def sanitize_client_id(self, name):
-        """Convert repeater name to valid MQTT client ID"""
+    def sanitize_client_id(self, name, broker_num=1):
+        """Convert repeater name to valid MQTT client ID, with a _N suffix for brokers 2-4"""
+        # Prefix and length limit are shared by all brokers and read from the MQTT1 settings
         prefix = self.get_env("MQTT1_CLIENT_ID_PREFIX", "meshcore_")
-        client_id = prefix + name.replace(" ", "_")
-        client_id = re.sub(r"[^a-zA-Z0-9_-]", "", client_id)
-        return client_id[:23]
+        suffix = f"_{broker_num}" if broker_num > 1 else ""
+        client_id = _sanitize_client_id_chars("", prefix + name.replace(" ", "_"))
+        if not self.get_env("MQTT1_CLIENT_ID_MAX_LENGTH"):
+            # Default: 23 characters (the MQTT 3.1 limit) before the suffix, as existing installs expect
+            return client_id[:23] + suffix
+        # An explicit limit covers the suffix and always leaves at least one character of the name
+        max_length = max(self.get_env_int("MQTT1_CLIENT_ID_MAX_LENGTH", 23), len(suffix) + 1)
+        return client_id[:max_length - len(suffix)] + suffix
     
-    def generate_auth_credentials(self, broker_num, force_refresh=False):
+    def generate_auth_credentials(self, broker_num, use_auth_token, audience, force_refresh=False):
         """Generate authentication credentials for a broker on-demand"""
-        use_auth_token = self.get_env_bool(f"MQTT{broker_num}_USE_AUTH_TOKEN", False)
-        
         if use_auth_token:
             if not self.repeater_priv_key:
                 logger.error(f"MQTT{broker_num}: Private key not available from device for auth token")
@@ -187,25 +237,24 @@ class MeshCoreBridge:
             
             # Check if we have a cached token that's still fresh
             current_time = time.time()
-            if not force_refresh and broker_num in self.token_cache:
-                cached_token, created_at = self.token_cache[broker_num]
+            if not force_refresh and audience in self.token_cache:
+                cached_token, created_at = self.token_cache[audience]
                 age = current_time - created_at
                 if age < (self.token_ttl - 300):  # Use cached token if it has >5min remaining
-                    logger.debug(f"MQTT{broker_num}: Using cached auth token (age: {age:.0f}s)")
+                    logger.debug("MQTT%s: Using cached auth token (age: %.0fs)", broker_num, age)
                     username = f"v1_{self.repeater_pub_key.upper()}"
                     return username, cached_token
             
             # Generate fresh token
             try:
                 username = f"v1_{self.repeater_pub_key.upper()}"
-                audience = self.get_env(f"MQTT{broker_num}_TOKEN_AUDIENCE", "")
                 claims = {}
                 if audience:
                     claims['aud'] = audience
                 
                 # Generate token with 1 hour expiry
                 password = create_auth_token(self.repeater_pub_key, self.repeater_priv_key, expiry_seconds=self.token_ttl, **claims)
-                self.token_cache[broker_num] = (password, current_time)
+                self.token_cache[audience] = (password, current_time)
                 logger.info(f"MQTT{broker_num}: Generated fresh auth token (1h expiry)")
                 return username, password
             except Exception as e:
@@ -216,6 +265,42 @@ class MeshCoreBridge:
             password = self.get_env(f"MQTT{broker_num}_PASSWORD", "")
             return username, password
 
+    def wake(self):
+        """Wake the main loop so it handles broker state changes without waiting for serial data"""
+        self.rx_event.set()
+
+    def serial_reader(self):
+        """Read lines from the serial port into rx_queue so MQTT or parsing stalls never hold up the UART"""
+        buffer = bytearray()
+        while not self.should_exit:
+            try:
+                # Block for the first byte, then take everything already waiting in one read
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except OSError:
+                if self.should_exit:
+                    break  # The port is being closed for shutdown, don't reopen it
+                logger.warning("Serial connection unavailable, trying to reconnect")
+                buffer.clear()
+                self.connect_serial()
+                sleep(0.5)
+                continue
+            if not data:
+                continue
+            buffer += data
+            if b"\n" not in data:
+                if len(buffer) > 65536:
+                    buffer.clear()  # No line ending in sight, drop the noise
+                continue
+            # Split off the complete lines and keep the partial tail for the next read
+            *lines, tail = bytes(buffer).split(b"\n")
+            del buffer[:len(buffer) - len(tail)]
+            for line in lines:
+                if line:
+                    if len(self.rx_queue) == self.rx_queue.maxlen:
+                        self.note_dropped("Serial")
+                    self.rx_queue.append(line)
+            self.rx_event.set()
+
     def connect_serial(self):
         ports = self.get_env("SERIAL_PORTS", "/dev/ttyACM0").split(",")
         baud_rate = self.get_env_int("SERIAL_BAUD_RATE", 115200)
@@ -233,8 +318,7 @@ class MeshCoreBridge:
                     rtscts=False
                 )
                 self.ser.write(b"\r\n\r\n")
-                self.ser.flushInput()
-                self.ser.flushOutput()
+                self.ser.reset_input_buffer()
                 logger.info(f"Connected to {port}")
                 return True
             except (serial.SerialException, OSError) as e:
@@ -243,35 +327,49 @@ class MeshCoreBridge:
         logger.error("Failed to connect to any serial port")
         return False
 
-    def set_repeater_time(self):
-        self.ser.flushInput()
-        self.ser.flushOutput()
-        epoc_time = int(calendar.timegm(time.gmtime()))
-        timecmd=f'time {epoc_time}\r\n'
-        self.ser.write(timecmd.encode())
-        logger.debug(f"Sent '{timecmd}' command")
+    def _cmd(self, cmd, terminator=b"-> >", deadline=1.0, log_response=True):
+        """Send a command and return the stripped response line after the prompt terminator"""
+        self.ser.write(cmd)
+        self.ser.flush()  # Wait for the command to leave the TX buffer so the deadline covers only the reply
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sent '%s' command", cmd.decode().strip())
+
+        # Read until the prompt and the rest of its line have arrived, or the deadline passes.
+        # Chunks are appended to one bytearray in place rather than rebuilding a bytes object per read.
+        response = bytearray()
+        timeout = self.ser.timeout
+        self.ser.timeout = 0.05
+        try:
+            end = time.monotonic() + deadline
+            while time.monotonic() < end:
+                response += self.ser.read(self.ser.in_waiting or 1)
+                idx = response.find(terminator)
+                if idx != -1 and b"\n" in response[idx:]:
+                    break
+        finally:
+            self.ser.timeout = timeout
 
-        sleep(0.5)
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw response: {response}")
+        if log_response and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Raw response: %s", bytes(response))
+
+        # Only the line after the prompt is decoded; banner text before it is skipped
+        idx = response.find(terminator)
+        if idx != -1:
+            line, _, _ = response[idx + len(terminator):].partition(b"\n")
+            return line.strip().decode(errors='replace')
+        return None
+
+    def set_repeater_time(self):
+        epoc_time = int(time.time())
+        self._cmd(f'time {epoc_time}\r\n'.encode(), terminator=b"-> ")
 
     def get_repeater_name(self):
         if not self.ser:
             return False
 
-        self.ser.flushInput()
-        self.ser.flushOutput()
-        self.ser.write(b"get name\r\n")
-        logger.debug("Sent 'get name' command")
-
-        sleep(0.5)
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw response: {response}")
-
-        if "-> >" in response:
-            self.repeater_name = response.split("-> >")[1].strip()
-            if '\n' in self.repeater_name:
-                self.repeater_name = self.repeater_name.split('\n')[0]
+        repeater_name = self._cmd(b"get name\r\n")
+        if repeater_name is not None:
+            self.repeater_name = repeater_name
             logger.info(f"Repeater name: {self.repeater_name}")
             return True
         
@@ -281,19 +379,10 @@ class MeshCoreBridge:
     def get_repeater_pubkey(self):
         if not self.ser:
             return False
-        self.ser.flushInput()
-        self.ser.flushOutput()
-        self.ser.write(b"get public.key\r\n")
-        logger.debug("Sent 'get public.key' command")
-
-        sleep(1.0)
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw response: {response}")
-
-        if "-> >" in response:
-            self.repeater_pub_key = response.split("-> >")[1].strip()
-            if '\n' in self.repeater_pub_key:
-                self.repeater_pub_key = self.repeater_pub_key.split('\n')[0]
+
+        repeater_pub_key = self._cmd(b"get public.key\r\n")
+        if repeater_pub_key is not None:
+            self.repeater_pub_key = repeater_pub_key
             logger.info(f"Repeater pub key: {self.repeater_pub_key}")
             return True
         
@@ -304,22 +393,13 @@ class MeshCoreBridge:
         if not self.ser:
             return False
         
-        self.ser.flushInput()
-        self.ser.flushOutput()
-        self.ser.write(b"get prv.key\r\n")
-        logger.debug("Sent 'get prv.key' command")
-
-        sleep(1.0)
-        response = self.ser.read_all().decode(errors='replace')
-        if "-> >" in response:
-            priv_key = response.split("-> >")[1].strip()
-            if '\n' in priv_key:
-                priv_key = priv_key.split('\n')[0]
-
-            priv_key_clean = priv_key.replace(' ', '').replace('\r', '').replace('\n', '')
+        # Keep the key out of the debug log
+        priv_key = self._cmd(b"get prv.key\r\n", deadline=2.0, log_response=False)
+        if priv_key is not None:
+            priv_key_clean = _strip_whitespace("", priv_key)
             if len(priv_key_clean) == 128:
                 try:
-                    int(priv_key_clean, 16)  # Validate it's hex
+                    bytes.fromhex(priv_key_clean)  # Validate it's hex
                     self.repeater_priv_key = priv_key_clean
                     logger.info(f"Repeater priv key: {self.repeater_priv_key[:4]}... (truncated for security)")
                     return True
@@ -336,20 +416,9 @@ class MeshCoreBridge:
         if not self.ser:
             return None
 
-        self.ser.flushInput()
-        self.ser.flushOutput()
-        self.ser.write(b"get radio\r\n")
-        logger.debug("Sent 'get radio' command")
-
-        sleep(0.5)  # Adjust delay if necessary
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw radio response: {response}")
-
-        if "-> >" in response:
-            radio_info = response.split("-> >")[1].strip()
-            if '\n' in radio_info:
-                radio_info = radio_info.split('\n')[0]
-            logger.debug(f"Parsed radio info: {radio_info}")
+        radio_info = self._cmd(b"get radio\r\n")
+        if radio_info is not None:
+            logger.debug("Parsed radio info: %s", radio_info)
             return radio_info
         
         logger.error("Failed to get radio info from response")
@@ -360,19 +429,9 @@ class MeshCoreBridge:
         if not self.ser:
             return None
 
-        self.ser.flushInput()
-        self.ser.flushOutput()
-        self.ser.write(b"ver\r\n")
-        logger.debug("Sent 'ver' command")
-
-        sleep(0.5)
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw version response: {response}")
-
         # Response format: "ver\n  -> 1.8.2-dev-834c700 (Build: 04-Sep-2025)\n"
-        if "-> " in response:
-            version = response.split("-> ", 1)[1]
-            version = version.split('\n')[0].replace('\r', '').strip()
+        version = self._cmd(b"ver\r\n", terminator=b"-> ")
+        if version is not None:
             logger.info(f"Firmware version: {version}")
             return version
         
@@ -384,19 +443,9 @@ class MeshCoreBridge:
         if not self.ser:
             return None
 
-        self.ser.flushInput()
-        self.ser.flushOutput()
-        self.ser.write(b"board\r\n")
-        logger.debug("Sent 'board' command")
-
-        sleep(0.5)
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw board response: {response}")
-
         # Response format: "board\n  -> Station G2\n"
-        if "-> " in response:
-            board_type = response.split("-> ", 1)[1]
-            board_type = board_type.split('\n')[0].replace('\r', '').strip()
+        board_type = self._cmd(b"board\r\n", terminator=b"-> ")
+        if board_type is not None:
             if board_type == "Unknown command":
                 board_type = "unknown"
             logger.info(f"Board type: {board_type}")
@@ -419,11 +468,12 @@ class MeshCoreBridge:
             
             # Check if this specific broker was already connected
             was_broker_connected = False
-            for mqtt_info in self.mqtt_clients:
-                if mqtt_info['broker_num'] == broker_num:
-                    was_broker_connected = mqtt_info.get('connected', False)
-                    mqtt_info['connected'] = True
-                    break
+            mqtt_info = self.mqtt_clients.get(broker_num)
+            if mqtt_info:
+                was_broker_connected = mqtt_info.get('connected', False)
+                mqtt_info['connected'] = True
+                # paho's own retry got through, so an earlier auth failure no longer needs a rebuild
+                mqtt_info.pop('needs_recreate', None)
             
             # Mark that at least one broker is connected
             self.mqtt_connected = True
@@ -434,24 +484,38 @@ class MeshCoreBridge:
                 logger.info(f"Reconnected to MQTT broker: {broker_name}")
             
             # Publish online status once on connection
-            self.publish_status("online", client, broker_num)
+            self.publish_status("online", broker_num)
         else:
-            # Check if this is an authorization error
-            if rc == 5:  # MQTT_ERR_AUTH / Not authorized
+            # Check if this is an authorization error (paho reports MQTT v5 style reason codes)
+            mqtt_info = self.mqtt_clients.get(broker_num)
+            if (rc == 135 or rc == 134) and mqtt_info and mqtt_info['use_auth_token']:  # Not authorized / Bad user name or password
                 logger.error(f"MQTT connection failed for {broker_name}: Not authorized - token will be regenerated on next reconnect")
                 # Clear the cached token to force regeneration on next attempt
-                if broker_num in self.token_cache:
+                audience = mqtt_info['token_audience']
+                if audience in self.token_cache:
                     logger.info(f"MQTT{broker_num}: Clearing cached token due to auth failure")
-                    del self.token_cache[broker_num]
+                    del self.token_cache[audience]
                 # Mark the client info for recreation
-                for mqtt_info in self.mqtt_clients:
-                    if mqtt_info['broker_num'] == broker_num:
-                        mqtt_info['needs_recreate'] = True
-                        logger.info(f"MQTT{broker_num}: Marked for recreation with fresh token")
-                        break
+                mqtt_info['needs_recreate'] = True
+                logger.info(f"MQTT{broker_num}: Marked for recreation with fresh token")
+            elif rc == 135 or rc == 134:
+                # A rebuilt client would send the same configured username/password
+                logger.error(f"MQTT connection failed for {broker_name}: Not authorized - check the configured username and password")
             else:
                 logger.error(f"MQTT connection failed for {broker_name} with code {rc}")
 
+    def on_mqtt_connect_fail(self, client, userdata):
+        broker_name = userdata.get('name', 'unknown') if userdata else 'unknown'
+        broker_num = userdata.get('broker_num', None) if userdata else None
+
+        # paho calls this from inside its except block, so the socket error is still available
+        error = sys.exc_info()[1]
+        logger.error(f"MQTT connection error for {broker_name}: {str(error) if error else 'connection failed'}")
+
+        # The attempt is over, so don't keep connect_mqtt waiting for it
+        if broker_num in self.connection_events:
+            self.connection_events[broker_num].set()
+
     def on_mqtt_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
         broker_name = userdata.get('name', 'unknown') if userdata else 'unknown'
         broker_num = userdata.get('broker_num', None) if userdata else None
@@ -459,23 +523,31 @@ class MeshCoreBridge:
         # Log more details about the disconnect
         logger.warning(f"Disconnected from MQTT broker {broker_name} (code: {reason_code}, flags: {disconnect_flags}, properties: {properties})")
         
-        # Mark this specific client as disconnected
-        for mqtt_info in self.mqtt_clients:
-            if mqtt_info['client'] == client:
-                mqtt_info['connected'] = False
-                mqtt_info['reconnect_at'] = time.time() + self.reconnect_delay
-                break
+        # Mark this specific client as disconnected (not a replacement created for the same broker)
+        mqtt_info = self.mqtt_clients.get(broker_num)
+        if mqtt_info and mqtt_info['client'] is client:
+            mqtt_info['connected'] = False
+            mqtt_info['reconnect_at'] = time.monotonic() + self.reconnect_delay
+            if mqtt_info['use_auth_token'] and not self.should_exit:
+                # Give paho's upcoming reconnect a current token; this runs before its retry,
+                # and the cached token is reused until it is within 5 minutes of expiry
+                username, password = self.generate_auth_credentials(broker_num, True, mqtt_info['token_audience'])
+                if username is not None:
+                    client.username_pw_set(username, password)
+
+        # Let the main loop check whether this broker needs to be rebuilt
+        self.wake()
         
         # Check if ALL brokers are disconnected
-        all_disconnected = all(not info.get('connected', False) for info in self.mqtt_clients)
+        all_disconnected = all(not info.get('connected', False) for info in list(self.mqtt_clients.values()))
         if all_disconnected:
             self.mqtt_connected = False
 
-    def publish_status(self, status, client=None, broker_num=None):
+    def publish_status(self, status, broker_num=None):
         """Publish status with additional information"""
         status_msg = {
             "status": status,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": self._iso_now(),
             "origin": self.repeater_name,
             "origin_id": self.repeater_pub_key,
             "radio": self.radio_info if self.radio_info else "unknown",
@@ -483,45 +555,68 @@ class MeshCoreBridge:
             "firmware_version": self.firmware_version if self.firmware_version else "unknown",
             "client_version": self.client_version
         }
-        status_topic = self.get_topic("status", broker_num)
-        if client:
-            self.safe_publish(status_topic, json.dumps(status_msg), retain=True, client=client, broker_num=broker_num)
-        else:
-            self.safe_publish(status_topic, json.dumps(status_msg), retain=True)
-        logger.debug(f"Published status: {status}")
+        self.safe_publish("status", self.encode_json(status_msg), retain=True, broker_num=broker_num)
+        logger.debug("Published status: %s", status)
 
-    def safe_publish(self, topic, payload, retain=False, client=None, broker_num=None):
-        """Publish to one or all MQTT brokers"""
+    def safe_publish(self, topic_type, payload, retain=False, broker_num=None):
+        """Publish to one or all MQTT brokers, using each broker's resolved topic for topic_type"""
         if not self.mqtt_connected:
-            logger.warning(f"Not connected - skipping publish to {topic}")
+            logger.warning(f"Not connected - skipping publish to {topic_type} topic")
             return False
 
         success = False
+        # Encode once here; paho would otherwise encode a str payload again for every broker
+        if isinstance(payload, str):
+            payload = payload.encode()
         
-        if client:
-            clients_to_publish = [info for info in self.mqtt_clients if info['client'] == client]
+        if broker_num is not None:
+            mqtt_client_info = self.mqtt_clients.get(broker_num)
+            clients_to_publish = (mqtt_client_info,) if mqtt_client_info else ()
         else:
-            clients_to_publish = self.mqtt_clients
+            clients_to_publish = self.mqtt_clients.values()
         
         for mqtt_client_info in clients_to_publish:
             broker_num = mqtt_client_info['broker_num']
+            topic = self.topics[broker_num].get(topic_type)
+            if not topic:
+                continue
             try:
                 mqtt_client = mqtt_client_info['client']
-                qos = self.get_env_int(f"MQTT{broker_num}_QOS", 0)
-                if qos == 1:
-                    qos = 0  # force qos=1 to 0 because qos 1 can cause retry storms
-                
-                result = mqtt_client.publish(topic, payload, qos=qos, retain=retain)
-                if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                result = mqtt_client.publish(topic, payload, qos=mqtt_client_info['qos'], retain=retain)
+                if result.rc != MQTT_OK:
                     logger.error(f"Publish failed to {topic} on MQTT{broker_num}: {mqtt.error_string(result.rc)}")
                 else:
-                    logger.debug(f"Published to {topic} on MQTT{broker_num}")
+                    logger.debug("Published to %s on MQTT%s", topic, broker_num)
                     success = True
             except Exception as e:
                 logger.error(f"Publish error to {topic} on MQTT{broker_num}: {str(e)}")
         
         return success
 
+    def note_dropped(self, queue_name):
+        """Count a message pushed out of a full queue, warning at most every 10 seconds"""
+        count = self.dropped[queue_name] = self.dropped.get(queue_name, 0) + 1
+        now = time.monotonic()
+        if now >= self.drop_warned_at.get(queue_name, 0):
+            logger.warning(f"{queue_name} queue full - dropped {count} oldest message(s) so far")
+            self.drop_warned_at[queue_name] = now + 10
+
+    def queue_publish(self, topic_type, payload, retain=False):
+        """Queue a message for the background publisher thread"""
+        if len(self.publish_queue) == self.publish_queue.maxlen:
+            self.note_dropped("Publish")
+        self.publish_queue.append((topic_type, payload, retain))
+        self.publish_event.set()
+
+    def publish_worker(self):
+        """Drain queued messages to the MQTT brokers so serial reads never wait on a publish"""
+        while not self.should_exit:
+            self.publish_event.wait()
+            self.publish_event.clear()
+            while self.publish_queue:
+                topic_type, payload, retain = self.publish_queue.popleft()
+                self.safe_publish(topic_type, payload, retain=retain)
+
     def connect_mqtt_broker(self, broker_num):
         """Connect to a single MQTT broker"""
         if not self.repeater_name:
@@ -531,12 +626,10 @@ class MeshCoreBridge:
         # Connect to broker
         try:
             if not self.get_env_bool(f"MQTT{broker_num}_ENABLED", False):
-                logger.debug(f"MQTT broker {broker_num} is disabled, skipping")
+                logger.debug("MQTT broker %s is disabled, skipping", broker_num)
                 return None
 
-            client_id = self.sanitize_client_id(self.repeater_pub_key)
-            if broker_num > 1:
-                client_id += f"_{broker_num}"
+            client_id = self.sanitize_client_id(self.repeater_pub_key, broker_num)
             
             logger.info(f"Connecting to MQTT{broker_num} with client ID: {client_id}")
             
@@ -545,7 +638,7 @@ class MeshCoreBridge:
             mqtt_client = mqtt.Client(
                 mqtt.CallbackAPIVersion.VERSION2,
                 client_id=client_id,
-                clean_session=False,
+                clean_session=True,  # Publish-only client: a persistent session would hold nothing useful
                 transport=transport
             )
             
@@ -555,28 +648,38 @@ class MeshCoreBridge:
             })
             
             # Generate authentication credentials
-            username, password = self.generate_auth_credentials(broker_num)
+            use_auth_token = self.get_env_bool(f"MQTT{broker_num}_USE_AUTH_TOKEN", False)
+            token_audience = self.get_env(f"MQTT{broker_num}_TOKEN_AUDIENCE", "")
+            username, password = self.generate_auth_credentials(broker_num, use_auth_token, token_audience)
             if username is None:
                 return None
             
             if username:
                 mqtt_client.username_pw_set(username, password)
             
-            lwt_topic = self.get_topic("status", broker_num)
-            lwt_payload = json.dumps({
+            # Topics only depend on the IATA code and public key, so resolve them once per broker
+            topics = {
+                topic_type: self.get_topic(topic_type, broker_num)
+                for topic_type in ("status", "packets", "debug")
+            }
+            lwt_topic = topics["status"]
+            lwt_payload = self.encode_json({
                 "status": "offline",
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": self._iso_now(),
                 "repeater": self.repeater_name,
                 "repeater_id": self.repeater_pub_key
             })
-            lwt_qos = self.get_env_int(f"MQTT{broker_num}_QOS", 0)
+            qos = self.get_env_int(f"MQTT{broker_num}_QOS", 0)
             lwt_retain = self.get_env_bool(f"MQTT{broker_num}_RETAIN", True)
             
-            mqtt_client.will_set(lwt_topic, lwt_payload, qos=lwt_qos, retain=lwt_retain)
-            logger.debug(f"MQTT{broker_num}: Set LWT")
+            mqtt_client.will_set(lwt_topic, lwt_payload, qos=qos, retain=lwt_retain)
+            logger.debug("MQTT%s: Set LWT", broker_num)
             
             mqtt_client.on_connect = self.on_mqtt_connect
+            mqtt_client.on_connect_fail = self.on_mqtt_connect_fail
             mqtt_client.on_disconnect = self.on_mqtt_disconnect
+            # paho's network thread reconnects on its own with exponential backoff
+            mqtt_client.reconnect_delay_set(min_delay=1, max_delay=int(self.max_reconnect_delay))
             
             
             server = self.get_env(f"MQTT{broker_num}_SERVER", "")
@@ -594,7 +697,7 @@ class MeshCoreBridge:
                 if tls_verify:
                     mqtt_client.tls_set(cert_reqs=ssl.CERT_REQUIRED)
                     mqtt_client.tls_insecure_set(False)
-                    logger.debug(f"MQTT{broker_num}: TLS/SSL enabled with certificate verification")
+                    logger.debug("MQTT%s: TLS/SSL enabled with certificate verification", broker_num)
                 else:
                     mqtt_client.tls_set(cert_reqs=ssl.CERT_NONE)
                     mqtt_client.tls_insecure_set(True)
@@ -605,18 +708,28 @@ class MeshCoreBridge:
                     path="/",
                     headers=None
                 )
-                logger.debug(f"MQTT{broker_num}: WebSocket transport configured")
+                logger.debug("MQTT%s: WebSocket transport configured", broker_num)
             
             keepalive = self.get_env_int(f"MQTT{broker_num}_KEEPALIVE", 120)
-            mqtt_client.connect(server, port, keepalive=keepalive)    
+            # Reuse the broker's event across client recreations; it signals connection completion
+            self.connection_events.setdefault(broker_num, threading.Event()).clear()
+            # Register the topics only once the broker is fully configured, so a broker that
+            # fails setup doesn't keep its topic types active
+            self.topics[broker_num] = topics
+            self.active_topic_types.update(topic_type for topic_type, topic in topics.items() if topic)
+            # Connect from the network thread so a slow broker doesn't block startup
+            mqtt_client.connect_async(server, port, keepalive=keepalive)
             mqtt_client.loop_start()
             
-            logger.info(f"Connected to MQTT{broker_num} at {server}:{port} (transport={transport}, tls={use_tls})")
+            logger.info(f"Connecting to MQTT{broker_num} at {server}:{port} (transport={transport}, tls={use_tls})")
             return {
                 'client': mqtt_client,
                 'broker_num': broker_num,
                 'server': server,
                 'port': port,
+                'qos': 0 if qos == 1 else qos,  # force qos=1 to 0 because qos 1 can cause retry storms
+                'use_auth_token': use_auth_token,
+                'token_audience': token_audience,
                 'connected': False,
                 'reconnect_at': 0
             }
@@ -629,12 +742,15 @@ class MeshCoreBridge:
         """Connect to all configured MQTT brokers and wait for all to complete initial connection"""
         # Try to connect to MQTT1, MQTT2, MQTT3, MQTT4 (can expand if needed)
         for broker_num in range(1, 5):
-            # Create an event for this broker to signal connection completion
-            self.connection_events[broker_num] = threading.Event()
+            # Clients from a previous attempt keep retrying in paho's network thread;
+            # wait for the outcome of their next attempt
+            if broker_num in self.mqtt_clients:
+                self.connection_events[broker_num].clear()
+                continue
             
             client_info = self.connect_mqtt_broker(broker_num)
             if client_info:
-                self.mqtt_clients.append(client_info)
+                self.mqtt_clients[broker_num] = client_info
         
         if len(self.mqtt_clients) == 0:
             logger.error("Failed to connect to any MQTT broker")
@@ -642,14 +758,16 @@ class MeshCoreBridge:
         
         logger.info(f"Initiated connection to {len(self.mqtt_clients)} MQTT broker(s)")
         
-        # Wait for all brokers to complete their initial connection attempt
-        max_wait = 10  # seconds per broker
-        for mqtt_info in self.mqtt_clients:
-            broker_num = mqtt_info['broker_num']
+        # Wait for all brokers to complete their initial connection attempt. They connect in
+        # parallel, so they share one deadline instead of waiting up to 10 seconds each.
+        deadline = time.monotonic() + 10
+        for broker_num, mqtt_info in self.mqtt_clients.items():
+            if mqtt_info.get('connected', False):
+                continue
             event = self.connection_events.get(broker_num)
             if event:
                 # Wait for this specific broker to complete (success or fail)
-                event.wait(timeout=max_wait)
+                event.wait(timeout=max(0, deadline - time.monotonic()))
         
         # Check if at least one connected
         if not self.mqtt_connected:
@@ -658,134 +776,129 @@ class MeshCoreBridge:
         
         return True
     
+    def schedule_retry(self, mqtt_info, current_time):
+        """Set the broker's next recreation attempt (monotonic) and grow the backoff delay"""
+        mqtt_info['reconnect_at'] = current_time + self.reconnect_delay
+        self.reconnect_delay = min(self.reconnect_delay * self.reconnect_backoff, self.max_reconnect_delay)
+
     def reconnect_disconnected_brokers(self):
-        """Check and reconnect any disconnected brokers with exponential backoff"""
-        current_time = time.time()
+        """Rebuild disconnected brokers whose auth token was rejected, with exponential backoff
+
+        Plain reconnects are left to paho's network thread, and on_mqtt_disconnect hands the
+        existing client a current token; a client is only rebuilt when the broker rejected it.
+        """
+        current_time = time.monotonic()
         
-        for i, mqtt_info in enumerate(self.mqtt_clients):
+        for broker_num, mqtt_info in list(self.mqtt_clients.items()):
             # Skip if already connected
             if mqtt_info.get('connected', False):
                 continue
             
-            # Check if it's time to attempt reconnect
+            # Check if it's time to attempt recreation
             if current_time < mqtt_info.get('reconnect_at', 0):
                 continue
             
-            broker_num = mqtt_info['broker_num']
-            
-            # Check if using auth tokens and if token is expired or close to expiring
-            use_auth_token = self.get_env_bool(f"MQTT{broker_num}_USE_AUTH_TOKEN", False)
-            if use_auth_token and broker_num in self.token_cache:
-                cached_token, created_at = self.token_cache[broker_num]
-                token_age = current_time - created_at
-                if token_age > (self.token_ttl - 300):
-                    logger.warning(f"MQTT{broker_num}: Token expired or near expiry (age: {token_age:.0f}s), recreating client")
-                    
-                    try:
-                        # Stop the old client
-                        old_client = mqtt_info['client']
-                        try:
-                            old_client.loop_stop()
-                            old_client.disconnect()
-                        except:
-                            pass
-                        
-                        # Clear cached token
-                        del self.token_cache[broker_num]
-                        
-                        # Create new client with fresh token
-                        new_client_info = self.connect_mqtt_broker(broker_num)
-                        if new_client_info:
-                            self.mqtt_clients[i] = new_client_info
-                            logger.info(f"MQTT{broker_num}: Successfully recreated client with fresh token")
-                        else:
-                            logger.error(f"MQTT{broker_num}: Failed to recreate client")
-                            mqtt_info['reconnect_at'] = current_time + self.reconnect_delay
-                            self.reconnect_delay = min(self.reconnect_delay * self.reconnect_backoff, self.max_reconnect_delay)
-                    except Exception as e:
-                        logger.error(f"MQTT{broker_num}: Error recreating client: {e}")
-                        mqtt_info['reconnect_at'] = current_time + self.reconnect_delay
-                        self.reconnect_delay = min(self.reconnect_delay * self.reconnect_backoff, self.max_reconnect_delay)
-                    
-                    continue
+            if not mqtt_info.get('needs_recreate', False):
+                continue
             
-            # Normal reconnect attempt
             try:
-                logger.info(f"Attempting to reconnect MQTT{broker_num}... (delay was {self.reconnect_delay:.1f}s)")
-                mqtt_info['client'].reconnect()
-                
-                # Update reconnect timing with exponential backoff
-                self.reconnect_delay = min(self.reconnect_delay * self.reconnect_backoff, self.max_reconnect_delay)
-                mqtt_info['reconnect_at'] = current_time + self.reconnect_delay
+                # Stop the old client
+                old_client = mqtt_info['client']
+                try:
+                    old_client.loop_stop()
+                    old_client.disconnect()
+                except:
+                    pass
                 
+                # Create new client with fresh token
+                new_client_info = self.connect_mqtt_broker(broker_num)
+                if new_client_info:
+                    self.mqtt_clients[broker_num] = new_client_info
+                    logger.info(f"MQTT{broker_num}: Successfully recreated client with fresh token")
+                    continue
+                logger.error(f"MQTT{broker_num}: Failed to recreate client")
             except Exception as e:
-                logger.warning(f"Reconnect attempt failed for MQTT{broker_num}: {e}")
-                # Update reconnect timing with exponential backoff
-                self.reconnect_delay = min(self.reconnect_delay * self.reconnect_backoff, self.max_reconnect_delay)
-                mqtt_info['reconnect_at'] = current_time + self.reconnect_delay
+                logger.error(f"MQTT{broker_num}: Error recreating client: {e}")
+            self.schedule_retry(mqtt_info, current_time)
         
     def parse_and_publish(self, line):
-        if not line:
-            return
-        logger.debug(f"From Radio: {line}")
-        message = {
-            "origin": self.repeater_name,
-            "origin_id": self.repeater_pub_key,
-            "timestamp": datetime.now().isoformat()
-        }
-
-        # Handle RAW messages
-        if "U RAW:" in line:
-            parts = line.split("U RAW:")
-            if len(parts) > 1:
-                self.last_raw = parts[1].strip()
+        """Parse a raw serial line (bytes) and queue the resulting MQTT messages"""
+        line = line.strip()
+        # Dispatch on the marker that follows the timestamp (" U: " for packets, " U RAW: " for RAW
+        # lines). The date has no fixed width, so locate it once rather than scanning for each kind.
+        if line.startswith(b"DEBUG"):
+            if not self.debug or "debug" not in self.active_topic_types:
+                return
+            marker = -1
+        else:
+            marker = line.find(b" U")
+            if marker == -1:
+                return
+            tag = line[marker + 2:marker + 7]
+            if tag == b" RAW:":
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("From Radio: %s", line.decode(errors='replace'))
+                self.last_raw = line[marker + 7:].strip().decode(errors='replace')
+                self.last_raw_time = time.monotonic()
+                return
+            # Skip parsing packets when no broker has a packets topic; RAW lines are still tracked above
+            if not tag.startswith(b": ") or "packets" not in self.active_topic_types:
+                return
+        line = line.decode(errors='replace')
+        logger.debug("From Radio: %s", line)
+        # Bind the attributes used on the publish paths once per line
+        queue_publish = self.queue_publish
+        encode_json = self.encode_json
+        message_prefix = self.message_prefix
 
         # Handle DEBUG messages
-        if self.debug:
-            if line.startswith("DEBUG"):
-                message.update({
-                    "type": "DEBUG",
-                    "message": line
-                })
-                debug_topic = self.get_topic("debug")
-                if debug_topic:
-                    self.safe_publish(debug_topic, json.dumps(message))
-                return
+        if marker == -1:
+            queue_publish("debug", message_prefix + encode_json({
+                "timestamp": self._iso_now(),
+                "type": "DEBUG",
+                "message": line
+            })[1:])
+            return
 
         # Handle Packet messages (RX and TX)
-        packet_match = PACKET_PATTERN.match(line)
+        packet_match = _match_packet_header(line)
         if packet_match:
-            packet_type = packet_match.group(5)
-            payload = {
+            # Don't attach a RAW line that belongs to an earlier packet
+            raw = self.last_raw
+            if raw is not None and time.monotonic() - self.last_raw_time > self.raw_max_age:
+                raw = None
+            packet_time, packet_date, direction, length, packet_type, route, payload_len = packet_match.groups()
+            direction = _DIRECTIONS[direction]  # rx or tx
+            # Build the whole message in one literal rather than merging dicts
+            # origin and origin_id come from the pre-encoded message prefix
+            message = {
+                "timestamp": self._iso_now(),
                 "type": "PACKET",
-                "direction": packet_match.group(3).lower(),  # rx or tx
-                "time": packet_match.group(1),
-                "date": packet_match.group(2),
-                "len": packet_match.group(4),
+                "direction": direction,
+                "time": packet_time,
+                "date": packet_date,
+                "len": length,
                 "packet_type": packet_type,
-                "route": packet_match.group(6),
-                "payload_len": packet_match.group(7),
-                "raw": self.last_raw
+                "route": route,
+                "payload_len": payload_len,
+                "raw": raw
             }
 
             # Add SNR, RSSI, score, and hash for RX packets
-            if packet_match.group(3).lower() == "rx":
-                payload.update({
-                    "SNR": packet_match.group(8),
-                    "RSSI": packet_match.group(9),
-                    "score": packet_match.group(10),
-                    "duration": packet_match.group(12),
-                    "hash": packet_match.group(13)
-                })
+            if direction == "rx":
+                tail_match = _match_packet_rx_tail(line, packet_match.end())
+                snr, rssi, score, duration, packet_hash, path = tail_match.groups() if tail_match else (None,) * 6
+                message["SNR"] = snr
+                message["RSSI"] = rssi
+                message["score"] = score
+                message["duration"] = duration
+                message["hash"] = packet_hash
 
                 # Add path for route=D
-                if packet_match.group(6) == "D" and packet_match.group(14):
-                    payload["path"] = packet_match.group(14)
+                if route == "D" and path:
+                    message["path"] = path
 
-            message.update(payload)
-            packets_topic = self.get_topic("packets")
-            if packets_topic:
-                self.safe_publish(packets_topic, json.dumps(message))
+            queue_publish("packets", message_prefix + encode_json(message)[1:])
             return
 
     def run(self):
@@ -801,6 +914,13 @@ class MeshCoreBridge:
         if not self.get_repeater_pubkey():
             logger.error("Failed to get the repeater id (public key)")
             return
+
+        # The origin fields never change, so encode them once and splice them into each message
+        origin = self.encode_json({
+            "origin": self.repeater_name,
+            "origin_id": self.repeater_pub_key
+        })
+        self.message_prefix = origin[:-1] + (b"," if isinstance(origin, bytes) else ",")
         
         if not self.get_repeater_privkey():
             logger.warning("Failed to get repeater private key - auth token authentication will not be available")
@@ -839,34 +959,48 @@ class MeshCoreBridge:
         if retry_count >= max_initial_retries:
             logger.error("Failed to establish initial MQTT connection after maximum retries")
             return
+
+        threading.Thread(target=self.publish_worker, daemon=True).start()
+
+        reader = threading.Thread(target=self.serial_reader, daemon=True)
+        reader.start()
+        next_broker_check = 0.0
         
         try:
             while True:
                 if self.should_exit:
                     sys.exit(-1)
                 
-                # Check and reconnect any disconnected brokers
-                self.reconnect_disconnected_brokers()
-                
-                try:
-                    # Check for serial data
-                    if self.ser.in_waiting > 0:
-                        line = self.ser.readline().decode(errors='replace').strip()
-                        logger.debug(f"RX: {line}")
-                        self.parse_and_publish(line)
-                except OSError:
-                   logger.warning("Serial connection unavailable, trying to reconnect")
-                   self.connect_serial()
-                   sleep(0.5)
-                sleep(0.01)
-                
+                # Check and reconnect any disconnected brokers, at most twice a second during bursts
+                now = time.monotonic()
+                if now >= next_broker_check:
+                    self.reconnect_disconnected_brokers()
+                    next_broker_check = now + 0.5
+
+                # Sleep until serial lines arrive, a broker disconnects, or the timeout passes
+                self.rx_event.wait(1.0)
+                self.rx_event.clear()
+                debug_enabled = logger.isEnabledFor(logging.DEBUG)
+                while self.rx_queue:
+                    line = self.rx_queue.popleft()
+                    if debug_enabled:
+                        logger.debug("RX: %s", line.strip().decode(errors='replace'))
+                    self.parse_and_publish(line)
+
         except KeyboardInterrupt:
             logger.info("\nExiting...")
-            for mqtt_client_info in self.mqtt_clients:
+            self.should_exit = True
+            for mqtt_client_info in self.mqtt_clients.values():
                 try:
                     mqtt_client_info['client'].disconnect()
                 except:
                     pass
+            # Wake the reader out of its blocking read and let it finish before closing the port
+            try:
+                self.ser.cancel_read()
+            except:
+                pass
+            reader.join(timeout=2)
             self.ser.close()
 
 if __name__ == "__main__":